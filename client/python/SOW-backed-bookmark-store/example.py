@@ -27,11 +27,14 @@
 
 import sow_bookmark_store
 import AMPS
+import logging
 import time
 
+logger = logging.getLogger(__name__)
+
 #  Handler
 #
-#  Simple message handler that prints each message, then
+#  Simple message handler that logs each message at DEBUG level, then
 #  discards it.
 
 class Handler:
@@ -39,7 +42,8 @@ class Handler:
         self._client = client
 
     def __call__(self, message):
-        print message.get_data()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", message.get_data())
         try:
             self._client.discard(message)
         except:
@@ -47,6 +51,9 @@ class Handler:
 
 # Main example begins here
 
+# Set the level to logging.DEBUG to see each message as it is received.
+logging.basicConfig(level=logging.INFO)
+
 # Construct a client for the bookmark store to use.
 # For example purposes, this connects to the same instance that the
 # main client will use.
@@ -68,23 +75,24 @@ haclient.set_server_chooser(chooser)
 
 # Construct and set the bookmark store. Notice that the bookmark client
 # is already constructed and connected.
-haclient.set_bookmark_store(sow_bookmark_store.sow_bookmark_store(bkmrkclient, "/amps/bookmarkStore", "haclient"))
+store = sow_bookmark_store.sow_bookmark_store(bkmrkclient, "/amps/bookmarkStore", "haclient")
+haclient.set_bookmark_store(store)
 
 haclient.connect_and_logon()
 
 haclient.bookmark_subscribe(Handler(haclient), "orders", "recent")
 
-print "Subscribed, using the most recent bookmark."
-print "Publishing some messages."
+print("Subscribed, using the most recent bookmark.")
+print("Publishing some messages.")
 
-for i in xrange(10):
+for i in range(10):
     haclient.publish("orders", "{'data':'%d'}" % (i))
 
 time.sleep(2)
 
 haclient.disconnect()
 
-print "Disconnected the subscriber."
+print("Disconnected the subscriber.")
 
 publisher = AMPS.HAClient("haclient-pub")
 chooser2 = AMPS.DefaultServerChooser()
@@ -92,16 +100,16 @@ chooser2.add("tcp://localhost:9007/amps/json")
 publisher.set_server_chooser(chooser2)
 publisher.connect_and_logon()
 
-print "Publishing messages from a separate publisher."
+print("Publishing messages from a separate publisher.")
 
 # publish a few messages while the client is disconnected.
-for i in xrange(3):
+for i in range(3):
     publisher.publish("orders", "{'data':'%d', 'publisher':'New publisher'}" % (i + 10))
 
-print "Done publishing."
+print("Done publishing.")
 time.sleep(2)
 
-print "Reconnecting the subscriber -- the subscription will resume and see the new messages."
+print("Reconnecting the subscriber -- the subscription will resume and see the new messages.")
 
 haclient.connect_and_logon()
 
@@ -109,3 +117,6 @@ haclient.connect_and_logon()
 time.sleep(2)
 
 haclient.disconnect()
+
+# Publish any bookmarks the store has not written yet.
+store.close()
@@ -29,8 +29,11 @@
 
 """
 This bookmark store uses AMPS to persist progress through a bookmark
-subscription. The store publishes an update to AMPS as each message is
-discarded.
+subscription. As each message is discarded, the store records the latest
+bookmark for the subscription in memory and publishes the pending bookmarks
+to AMPS in batches: periodically, when enough subscriptions have pending
+updates, or when flush() is called. Since the SOW topic keeps only one record
+per client and subscription, intermediate bookmarks never need to be sent.
 
 This bookmark store is designed to support a specific application
 scenario. There are important limitations with this store (described following)
@@ -87,6 +90,17 @@ Usage:
       subscription when the client is done with it. Each call to discard
       will update the bookmark store.
         -On recovery, this message is considered the last message processed by the subscriber.
+    - A batch of messages can be discarded at once with
+      store.discard_many(messages), which records only the last bookmark for
+      each subscription in the batch.
+    - Call close() on the bookmark store before shutting down so that
+      any pending bookmarks are published.
+    - Instead of a client, the bookmark store can be given the URI of the
+      instance that contains the topic, for example
+      "tcp://localhost:9007/amps/json". Stores constructed with the same URI
+      share one connected HAClient, which is disconnected when the last of
+      those stores is closed. get_or_create_bookmark_client(uri) and
+      release_bookmark_client(uri) give other code access to the same client.
 
 Restrictions:
     - This implementation does not support Bookmark Live subscriptions: do
@@ -99,22 +113,155 @@ Restrictions:
       that places the subscription. 
 
 Important Notes:
-    -discard(message) will throw an exception if client is not connected.
+    -Bookmarks are published by a background writer thread, so
+     discard(message) does not wait for the bookmark store.
+    -If the writer fails to publish (for example, because the client is not
+     connected), the next call to discard(message), flush() or close()
+     throws an exception, unless a retry has succeeded in the meantime.
         -This exception should be handled by the caller.
         -Exceptions are not thrown if the client is connected, but
          fails to write (for example, due to lack of entitlements).
+        -Bookmarks that could not be published remain pending and are
+         retried by the writer.
+    -Bookmarks discarded since the last flush are lost if the process exits
+     without calling close(). On recovery, the subscription resumes from the
+     last published bookmark, so those messages are redelivered.
+    -The store keeps the most recent bookmark for at most max_tracked_subs
+     subscriptions in memory. When a subscription that was dropped from
+     memory resubscribes, its bookmark is read back from the SOW topic. If
+     recovery finds more records than that, an arbitrary subset of them is
+     kept in memory.
 
 """
-import json
+import collections
+import itertools
+import os
+import socket
+import threading
+import time
+import weakref
 import AMPS
 
+# Recovery parses one record per subscription; use a C parser when one is installed.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    try:
+        from ujson import loads as _json_loads
+    except ImportError:
+        from json import loads as _json_loads
+
+# Only the fields recovery needs are returned by the server. AMPS requires a
+# grouping with a projection; records are keyed by client name and subId, so
+# grouping by subId within one client name leaves every record as it is.
+_RECOVERY_OPTIONS = "projection=[/subId,/bookmark],grouping=[/subId]"
+# Projected records are small, so have the server send many per batch.
+_RECOVERY_BATCH_SIZE = 1000
+
+
+def _json_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _escape_single_quotes(value):
+    # for use inside a single-quoted AMPS filter string literal
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+# How long the idle writer waits for an update before checking whether the
+# store is still alive.
+_IDLE_WAIT = 1.0
+
+
+# Connected bookmark clients shared by URI, with the number of users of each.
+_clients = {}
+_clientRefs = {}
+_clientsLock = threading.Lock()
+_clientIds = itertools.count(1)
+
+
+def get_or_create_bookmark_client(uri):
+    """ Returns a connected HAClient for the bookmark store instance at uri. Every caller
+    that passes the same uri gets the same client. Each call must be matched by a
+    call to release_bookmark_client(uri).
+
+    :param uri: The URI of the instance that contains the bookmark store topic.
+    :type uri: string
+
+    :returns: AMPS.HAClient
+
+    :raises AMPS.AMPSException: if the client cannot connect and log on.
+    """
+    with _clientsLock:
+        client = _clients.get(uri)
+        if client is not None:
+            _clientRefs[uri] += 1
+            return client
+
+    # Connect without holding the lock: an HAClient can retry an unreachable server for a
+    # long time, and that must not hold up other URIs or release_bookmark_client().
+    # The HAClient reconnects on its own, so it stays usable for as long as it is shared.
+    client = AMPS.HAClient("sow_bookmark_store-%s-%d-%d" % (socket.gethostname(), os.getpid(), next(_clientIds)))
+    chooser = AMPS.DefaultServerChooser()
+    chooser.add(uri)
+    client.set_server_chooser(chooser)
+    client.connect_and_logon()
+
+    with _clientsLock:
+        shared = _clients.get(uri)
+        if shared is None:
+            shared = _clients[uri] = client
+            _clientRefs[uri] = 0
+        _clientRefs[uri] += 1
+    if shared is not client:
+        # another thread connected a client for this uri first
+        client.disconnect()
+    return shared
+
+
+def release_bookmark_client(uri):
+    """ Releases a client returned by get_or_create_bookmark_client(uri), disconnecting
+    it once it is no longer used.
+
+    :param uri: The URI the client was requested for.
+    :type uri: string
+    """
+    with _clientsLock:
+        if uri not in _clientRefs:
+            return
+        _clientRefs[uri] -= 1
+        if _clientRefs[uri] > 0:
+            return
+        del _clientRefs[uri]
+        client = _clients.pop(uri)
+    client.disconnect()
+
+
+def _writer_loop(store_ref):
+    # The writer only holds a weak reference between batches so that an
+    # abandoned store can still be collected (and flushed by __del__).
+    while True:
+        store = store_ref()
+        if store is None or not store._write_pending():
+            return
+        del store
+
 
 class sow_bookmark_store(object):
-    def __init__(self, bookmark_client, topic, tracked_client_name):
+    # One store is created per HAClient and its attributes are read on every discard.
+    # __weakref__ is needed for the writer thread's reference to the store.
+    __slots__ = ('_clientUri', '_internalClient', '_trackedName', '_topic', '_tmpl', '_filter',
+                 '_mostRecentBookmark', '_flushInterval', '_maxPending', '_pending', '_cv', '_inflight',
+                 '_flushRequested', '_writerError', '_closed', '_hardFlush', '_writer', '_maxTracked',
+                 '_evicted', '__weakref__')
+
+    def __init__(self, bookmark_client, topic, tracked_client_name, flush_interval_ms=100, max_pending=1000,
+                 max_tracked_subs=4096):
         """ Class for creating and managing a SOW bookmark store
 
-        :param bookmark_client: The client that will become the bookmark store internal client
-        :type bookmark_client: AMPS.HAClient
+        :param bookmark_client: The client that will become the bookmark store internal client, or the URI
+            of the instance to get a shared client for from get_or_create_bookmark_client().
+        :type bookmark_client: AMPS.HAClient or string
 
         :param topic: The SOW topic defined in the config that will be used for the bookmark store.
         :type topic: string
@@ -122,26 +269,205 @@ class sow_bookmark_store(object):
         :param tracked_client_name: The name of the client whos bookmarks we will be storing.
         :type tracked_client_name: string
 
+        :param flush_interval_ms: How long the writer collects updates before publishing them, in milliseconds.
+        :type flush_interval_ms: int
+
+        :param max_pending: The number of subscriptions with pending bookmarks that triggers a publish.
+        :type max_pending: int
+
+        :param max_tracked_subs: The number of subscriptions whose most recent bookmark is kept in memory.
+            Bookmarks for the least recently discarded subscriptions beyond this are read back from the
+            SOW topic when needed. If recovery finds more records than this, an arbitrary subset is kept.
+        :type max_tracked_subs: int
+
+        :raises ValueError: if tracked_client_name is not a non-empty string, flush_interval_ms is
+            negative, or max_pending or max_tracked_subs is less than 1.
         :raises AMPS.AMPSException: if the internal client fails to query the SOW.
 
         """
+        if not isinstance(tracked_client_name, str) or not tracked_client_name:
+            raise ValueError("tracked_client_name must be a non-empty string")
+        if flush_interval_ms < 0:
+            raise ValueError("flush_interval_ms must not be negative")
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+        if max_tracked_subs < 1:
+            raise ValueError("max_tracked_subs must be at least 1")
+        self._clientUri = None
+        if isinstance(bookmark_client, str):
+            self._clientUri = bookmark_client
+            bookmark_client = get_or_create_bookmark_client(self._clientUri)
         self._internalClient = bookmark_client
         self._trackedName = tracked_client_name
         self._topic = topic
-        self._mostRecentBookmark = {}
+        # The client name is fixed, so escape it once and leave only subId and bookmark to fill in.
+        self._tmpl = '{"clientName": "%s", "subId": "%%s", "bookmark": "%%s"}' % \
+            _json_escape(tracked_client_name).replace('%', '%%')
+        self._filter = "/clientName = '%s'" % _escape_single_quotes(tracked_client_name)
+        self._flushInterval = flush_interval_ms / 1000.0
+        self._maxPending = max_pending
+        self._maxTracked = max_tracked_subs
+        self._evicted = False
+        # Latest bookmark per subId that has not been handed to the writer yet.
+        self._pending = {}
+        self._cv = threading.Condition()
+        # The batch the writer is publishing; empty when it is not publishing.
+        self._inflight = {}
+        self._flushRequested = False
+        self._writerError = None
+        self._closed = False
+        # publish() only queues the message on the connection; flush() and close() also wait
+        # for the server to process everything published so far.
+        self._hardFlush = getattr(bookmark_client, 'publish_flush', None) or getattr(bookmark_client, 'flush', None)
 
         try:
-            for message in self._internalClient.sow(self._topic, "/clientName = '%s'" % self._trackedName):
-                if message.get_command() != 'sow':
-                    continue
+            messages = self._internalClient.sow(self._topic, self._filter,
+                                                batch_size=_RECOVERY_BATCH_SIZE, options=_RECOVERY_OPTIONS)
+            data = (message.get_data() for message in messages if message.get_command() == 'sow')
+            # skip records without a bookmark before paying for the parse
+            records = (_json_loads(d) for d in data if '"bookmark"' in d)
+            self._mostRecentBookmark = collections.OrderedDict((r['subId'], r['bookmark']) for r in records
+                                                               if 'bookmark' in r and 'subId' in r)
+        except AMPS.AMPSException as aex:
+            self._release_client()
+            raise AMPS.AMPSException("Error reading bookmark store", aex)
+        except BaseException:
+            # for example, a malformed record; the shared client must still be released
+            self._release_client()
+            raise
+        # The records carry nothing to order them by recency, so when there are more than
+        # max_tracked_subs an arbitrary subset is kept. The rest are read back from the SOW
+        # topic on demand, just like bookmarks evicted later.
+        while len(self._mostRecentBookmark) > self._maxTracked:
+            self._mostRecentBookmark.popitem(last=False)
+            self._evicted = True
+
+        self._writer = threading.Thread(target=_writer_loop, args=(weakref.ref(self),))
+        self._writer.daemon = True
+        self._writer.start()
+
+    def __del__(self):
+        # Nothing else can reach the store at this point and the writer is
+        # between batches, so publish whatever is left directly.
+        if not hasattr(self, '_writer'):
+            # construction failed before anything could be discarded
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            self._publish(pending)
+        except AMPS.AMPSException:
+            pass
+        self._release_client()
+
+    def _release_client(self):
+        uri, self._clientUri = self._clientUri, None
+        if uri is not None:
+            release_bookmark_client(uri)
+
+    def _publish(self, pending):
+        items = list(pending.items())
+        # bind everything the loop needs once; each record is then one format and one call
+        publish = self._internalClient.publish
+        topic = self._topic
+        tmpl = self._tmpl
+        for i, (subid, bookmark) in enumerate(items):
+            try:
+                publish(topic, tmpl % (subid, bookmark))
+            except AMPS.AMPSException:
+                # put back whatever was not published, unless a newer bookmark has arrived since
+                with self._cv:
+                    for unpublished in items[i:]:
+                        self._pending.setdefault(*unpublished)
+                raise
+
+    def _write_pending(self):
+        """ Run by the writer thread: wait for pending bookmarks, give further updates
+        flush_interval_ms to coalesce, then publish the latest bookmark for each subId.
+        Returns False once the store has been closed and nothing is left to publish.
+        """
+        with self._cv:
+            if not self._pending and not self._closed:
+                self._cv.wait(_IDLE_WAIT)
+            if not self._pending:
+                return not self._closed
+            deadline = time.monotonic() + self._flushInterval
+            while not (self._closed or self._flushRequested or len(self._pending) >= self._maxPending):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._cv.wait(timeout)
+            self._flushRequested = False
+            pending, self._pending = self._pending, {}
+            self._inflight = pending
+        try:
+            self._publish(pending)
+        except AMPS.AMPSException as aex:
+            with self._cv:
+                self._writerError = aex
+                if self._closed:
+                    return False
+                # back off before retrying
+                self._cv.wait(self._flushInterval or _IDLE_WAIT)
+        else:
+            with self._cv:
+                # the outage is over, so callers have nothing left to hear about
+                self._writerError = None
+        finally:
+            with self._cv:
+                self._inflight = {}
+                self._cv.notify_all()
+        return True
+
+    def _raise_writer_error(self):
+        if self._writerError is None:
+            return
+        with self._cv:
+            aex, self._writerError = self._writerError, None
+        if aex is not None:
+            raise AMPS.AMPSException("Error updating bookmark store", aex)
+
+    def flush(self):
+        """ Wait until every bookmark discarded so far has been published and processed by the server.
 
-                data = message.get_data()
-                bookmark_data = json.loads(data)
+        :raises AMPS.AMPSException: if the internal client cannot publish to the server.
+        """
+        with self._cv:
+            # only the writer clears the request, when it takes the pending bookmarks, so
+            # leaving it set with nothing pending would cut the next batch's interval short
+            if self._pending:
+                self._flushRequested = True
+                self._cv.notify_all()
+            while (self._pending or self._inflight) and self._writerError is None and not self._closed:
+                self._cv.wait()
+        self._raise_writer_error()
+        self._flush_client()
+
+    def close(self):
+        """ Publish any pending bookmarks and stop the writer thread. Discarding a message
+        after the store is closed raises an exception. A shared client the store was constructed
+        with a URI for is released.
+
+        :raises AMPS.AMPSException: if the internal client cannot publish to the server.
+        """
+        with self._cv:
+            if self._closed:
+                return
+            self._closed = True
+            self._cv.notify_all()
+        self._writer.join()
+        try:
+            self._raise_writer_error()
+            self._flush_client()
+        finally:
+            self._release_client()
 
-                if 'bookmark' in bookmark_data and 'subId' in bookmark_data:
-                    self._mostRecentBookmark[bookmark_data['subId']] = bookmark_data['bookmark']
+    def _flush_client(self):
+        if self._hardFlush is None:
+            return
+        try:
+            self._hardFlush()
         except AMPS.AMPSException as aex:
-            raise AMPS.AMPSException("Error reading bookmark store", aex)
+            raise AMPS.AMPSException("Error updating bookmark store", aex)
 
     def set_server_version(self, version):
         """ Internally used to set the server version so the store knows how to deal
@@ -161,13 +487,50 @@ class sow_bookmark_store(object):
 
         :returns: mostRecentBookmark[subid] or '0'
 
+        :raises AMPS.AMPSException: if the bookmark was evicted from memory and the internal client
+            fails to query the SOW.
+
         """
         # if we have a most recent value for that subId, then we'll return it
         # if not, we return EPOCH
-        if subid in self._mostRecentBookmark:
-            return self._mostRecentBookmark[subid]
-        else:
-            return '0'
+        with self._cv:
+            bookmark = self._mostRecentBookmark.get(subid)
+            evicted = self._evicted
+        if bookmark is not None:
+            return bookmark
+        if evicted:
+            return self._recover(subid)
+        return '0'
+
+    def _recover(self, subid):
+        # The subscription may have been evicted from _mostRecentBookmark, but its bookmark
+        # is still pending, being published, or in the SOW topic. The SOW record is older
+        # than either of the others until the writer has published them.
+        with self._cv:
+            bookmark = self._pending.get(subid)
+            if bookmark is None:
+                bookmark = self._inflight.get(subid)
+        if bookmark is None:
+            try:
+                for message in self._internalClient.sow(self._topic, "%s AND /subId = '%s'" %
+                                                        (self._filter, _escape_single_quotes(subid)),
+                                                        options=_RECOVERY_OPTIONS):
+                    if message.get_command() != 'sow':
+                        continue
+                    bookmark = _json_loads(message.get_data()).get('bookmark', bookmark)
+            except AMPS.AMPSException as aex:
+                raise AMPS.AMPSException("Error reading bookmark store", aex)
+        if bookmark is None:
+            # Remember that there is no record, so resubscribing does not query the SOW every
+            # time. The entry counts against max_tracked_subs and the next discard replaces it.
+            bookmark = '0'
+        with self._cv:
+            # a discard may have recorded a newer bookmark while the SOW was queried
+            current = self._mostRecentBookmark.get(subid)
+            if current is not None:
+                return current
+            self._remember(subid, bookmark)
+        return bookmark
 
     def is_discarded(self, message):
         """ Called for each arriving message to determine if the application has already seen this bookmark and
@@ -210,23 +573,63 @@ class sow_bookmark_store(object):
         pass
 
     def discard_message(self, message):
-        """ Mark a message as seen by the application.
+        """ Mark a message as seen by the application. The bookmark is published by the writer thread.
 
         :param message: The message to mark as seen.
         :type message: AMPS.Message
 
-        :raises AMPS.AMPSException: if the internal client cannot publish to the server.
+        :raises AMPS.AMPSException: if the writer thread failed to publish to the server, or the
+            store has been closed.
+        """
+        self._discard_pair(message.get_sub_id(), message.get_bookmark())
+
+    def discard_many(self, messages):
+        """ Mark a batch of messages as seen by the application. Only the last bookmark for each
+        subscription is recorded, so the messages for each subscription must appear in the
+        order in which they were received.
+
+        :param messages: The messages to mark as seen.
+        :type messages: iterable of AMPS.Message
+
+        :raises AMPS.AMPSException: if the writer thread failed to publish to the server, or the
+            store has been closed.
         """
-        subid = message.get_sub_id()
-        bookmark = message.get_bookmark()
+        latest = {}
+        for message in messages:
+            subid = message.get_sub_id()
+            bookmark = message.get_bookmark()
+            if subid is not None and bookmark is not None:
+                latest[subid] = bookmark
+        for subid, bookmark in latest.items():
+            self._discard_pair(subid, bookmark)
+
+    def _discard_pair(self, subid, bookmark):
+        # Takes the subId and bookmark already read from the message, so each
+        # accessor is called only once per message.
+        self._raise_writer_error()
         if bookmark is None or subid is None:
             return
-        msg = '{"clientName": "%s", "subId": "%s", "bookmark": "%s"}' % (self._trackedName, subid, bookmark)
-        try:
-            self._internalClient.publish(self._topic, msg)
-            self._mostRecentBookmark[subid] = bookmark
-        except AMPS.AMPSException as aex:
-            raise AMPS.AMPSException("Error updating bookmark store", aex)
+        with self._cv:
+            if self._closed:
+                # the writer has exited, so the bookmark would never be published
+                raise AMPS.AMPSException("Error updating bookmark store", "the bookmark store is closed")
+            # redelivered messages after a reconnect carry the bookmark we already have
+            if self._mostRecentBookmark.get(subid) == bookmark:
+                return
+            self._pending[subid] = bookmark
+            # the writer only needs waking when there is new work or the batch is full
+            if len(self._pending) == 1 or len(self._pending) >= self._maxPending:
+                self._cv.notify()
+            self._remember(subid, bookmark)
+
+    def _remember(self, subid, bookmark):
+        # Called with self._cv held. Keeps the most recently discarded subscriptions, up to max_tracked_subs.
+        recent = self._mostRecentBookmark
+        recent[subid] = bookmark
+        recent.move_to_end(subid)
+        if len(recent) > self._maxTracked:
+            recent.popitem(last=False)
+            self._evicted = True
 
     def discard(self, subid, seqnumber):
         """ Deprecated, Use discard(message) instead.